@@ -6,11 +6,21 @@ import requests
 import json
 import urllib.parse
 import sys
-import statistics
+import os
+import hashlib
 import numpy
 import traceback
 import time
 import math
+import concurrent.futures
+import threading
+from bisect import bisect_right
+from collections import defaultdict, deque
+
+try:
+	import orjson # Optional: much faster JSON parsing and serialization
+except ImportError:
+	orjson = None
 
 ####################################################################################################
 #
@@ -78,6 +88,12 @@ import math
 # will get all the months needed for each indicator in a single query.
 # The value of "maxGetMonths" must be no greater than count + 2.
 #
+# If "minPeerGroupSize" is configured, indicator statistics are not
+# computed or stored for peer groups with fewer reporting organisation
+# units than this, since quartiles and ranks among a very few peers say
+# little. If there is no "minPeerGroupSize", statistics are computed
+# for every peer group with any reporting organisation unit.
+#
 # The area average for each organisation unit is computed as the average of the
 # averages in that area. This is stored in the data element named 'Overall Average: '
 # follwed by the indicator group name for that area. The area average is compared
@@ -116,12 +132,23 @@ import math
 #
 # 2020-01-10 12:28:19.854 http://localhost:8080 0:02:11 imported: 0, updated: 10068, ignored: 0
 #
+# If the directory /usr/local/var/cache/dashcalc exists and it has write
+# access, metadata query results (indicators, data elements, group sets)
+# are cached there and reused for up to 24 hours, so most nightly runs
+# skip the metadata queries. The same directory also keeps a hash of
+# each peer group's input data from the last successful run, so peer
+# groups whose data has not changed are not recomputed or reimported.
+#
 # This script requires the following (you may need to replace pip with pip3):
 #
 #    pip install requests
 #    pip install python-dateutil
 #    pip install numpy
 #
+# Optionally, for faster JSON handling:
+#
+#    pip install orjson
+#
 ####################################################################################################
 
 startTime = datetime.datetime.now()
@@ -154,9 +181,23 @@ orgUnitLevel = dhis['orgUnitLevel']
 peerLevel = dhis.get('peerLevel', orgUnitLevel + 1)
 monthCount = dhis.get('count', 1)
 maxGetMonths = dhis.get('maxGetMonths', monthCount + 2)
+minPeerGroupSize = dhis.get('minPeerGroupSize', 1)
+
+#
+# Use one session for all API calls, so the TCP (and TLS) connections
+# are set up once and reused.
+#
+session = requests.Session()
+session.auth = credentials
+session.headers['Accept-Encoding'] = 'gzip' # Compress the large JSON responses
+retries = requests.adapters.Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504]) # Retries GETs at the connection level; POSTs are retried in postRows
+adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retries) # Enough pooled connections for the parallel fetches
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+requestTimeout = 300 # Seconds before giving up on an unresponsive server, so a hung request can't stall the run forever
 
 try:
-	response = requests.get(api + 'me', auth=credentials)
+	response = session.get(api + 'me', timeout=requestTimeout)
 	if response.status_code != 200:
 		print('Error connecting to DHIS 2 system at "' + baseUrl + '" with username "' + dhis['username'] + '":', response)
 		sys.exit(1)
@@ -193,9 +234,11 @@ def d2get(args, objects):
 	retry = 0 # Sometimes gets a [502] error, waiting and retrying helps
 	while True:
 		# print(api + args) # debug
-		response = requests.get(api + args.replace('[','%5B').replace(']','%5D'), auth=credentials)
+		response = session.get(api + args.replace('[','%5B').replace(']','%5D'), timeout=requestTimeout)
 		try:
 			# print(api + args + ' --', len(response.json()[objects]))
+			if orjson:
+				return orjson.loads(response.content)[objects]
 			return response.json()[objects]
 		except:
 			retry = retry + 1
@@ -206,7 +249,32 @@ def d2get(args, objects):
 
 def d2post(args, data):
 	# print(api + args, len(json.dumps(data)), "bytes.")
-	return requests.post(api + args, json=data, auth=credentials)
+	if orjson:
+		return session.post(api + args, data=orjson.dumps(data), headers={'Content-Type': 'application/json'}, timeout=requestTimeout)
+	return session.post(api + args, json=data, timeout=requestTimeout)
+
+#
+# Get metadata through an on-disk cache (if the cache directory exists
+# and is writable). Metadata such as indicators and data elements rarely
+# changes, so a cached copy less than a day old is used instead of
+# asking the server again on every run.
+#
+metadataCacheDir = '/usr/local/var/cache/dashcalc'
+metadataCacheSeconds = 24 * 60 * 60
+
+def d2getCached(args, objects):
+	cacheFile = metadataCacheDir + '/' + hashlib.sha1( (baseUrl + ' ' + args).encode() ).hexdigest() + '.json'
+	try:
+		if time.time() - os.path.getmtime(cacheFile) < metadataCacheSeconds:
+			return json.loads(open(cacheFile).read())
+	except Exception:
+		pass # No valid cached copy - ask the server
+	result = d2get(args, objects)
+	try:
+		open(cacheFile, 'w').write(json.dumps(result))
+	except Exception:
+		pass # Can't cache - no problem, just slower next run
+	return result
 
 #
 # If the org unit group set 'Dashboard groups' exists, then
@@ -215,25 +283,25 @@ def d2post(args, data):
 # The peer group identifier is the common ancestor org unit
 # UID follwed by the org unit group name.
 #
-# Also, remember the various org unit levels at which we will need to collect data.
-#
 peerGroupMap = {}
-dataOrgUnitLevels = set()
-groupSets = d2get('organisationUnitGroupSets.json?filter=name:eq:Dashboard+groups&fields=organisationUnitGroups[name,organisationUnits[id,level,path,closedDate]]', 'organisationUnitGroupSets')
+startOfCurrentMonthStr = str(startOfCurrentMonth)
+ancestorSlice = slice(12*orgUnitLevel-11, 12*orgUnitLevel) # Ancestor UID at orgUnitLevel within the path
+parentSlice = slice(-23, -12) # Parent UID within the path
+groupSets = d2getCached('organisationUnitGroupSets.json?filter=name:eq:Dashboard+groups&fields=organisationUnitGroups[name,organisationUnits[id,level,path,closedDate]]', 'organisationUnitGroupSets')
 if groupSets:
 	for ouGroup in groupSets[0]['organisationUnitGroups']:
 		# print("ouGroup", ouGroup)
+		groupSuffix = '-' + ouGroup['name']
 		for facility in ouGroup['organisationUnits']:
-			if 'closedDate' not in facility or facility['closedDate'] >= str(startOfCurrentMonth):
+			if 'closedDate' not in facility or facility['closedDate'] >= startOfCurrentMonthStr:
 				if facility['level'] > orgUnitLevel:
-					ancestor = facility['path'][12*orgUnitLevel-11:12*orgUnitLevel]
+					ancestor = facility['path'][ancestorSlice]
 				elif facility['level'] > 1:
-					ancestor = facility['path'][-23:-12]
+					ancestor = facility['path'][parentSlice]
 				else:
 					continue # Path too short to have a parent - ignore
-				peerGroupMap[facility['id']] = ancestor + '-' + ouGroup['name']
-				dataOrgUnitLevels.add(facility['level'])
-				# print('peerGroupMap:', facility['id'], facility['path'], ancestor + '-' + ouGroup['name']) # debug
+				peerGroupMap[facility['id']] = ancestor + groupSuffix
+				# print('peerGroupMap:', facility['id'], facility['path'], ancestor + groupSuffix) # debug
 
 #
 # If the org unit group set 'Dashboard groups' does not exist, then
@@ -241,40 +309,43 @@ if groupSets:
 # identifier is the ancestor org unit UID
 #
 else:
-	dataOrgUnitLevels.add(peerLevel)
 	facilities = d2get('organisationUnits.json?filter=level:eq:' + str(peerLevel) + '&fields=id,path,closedDate&paging=false', 'organisationUnits')
 	for facility in facilities:
-		if 'closedDate' not in facility or facility['closedDate'] >= str(startOfCurrentMonth):
-			ancestor = facility['path'][12*orgUnitLevel-11:12*orgUnitLevel]
-			peerGroupMap[facility['id']] = ancestor
-			# print('peerGroupMap:', facility['id'], ancestor, facility['path']) # debug
+		if 'closedDate' not in facility or facility['closedDate'] >= startOfCurrentMonthStr:
+			peerGroupMap[facility['id']] = facility['path'][ancestorSlice]
+			# print('peerGroupMap:', facility['id'], peerGroupMap[facility['id']], facility['path']) # debug
 
 #
-# Get a list of all indicators.
+# Get a list of the dashboard indicators. The server-side filter matches
+# 'dash' anywhere in the UID, so the prefix is still checked below.
 #
-indicators = d2get('indicators.json?fields=id&paging=false', 'indicators')
+indicators = d2getCached('indicators.json?fields=id&filter=id:like:dash&paging=false', 'indicators')
 
 #
 # Get a list of all data elements.
 #
-dataElements = d2get('dataElements.json?fields=id,name&paging=false', 'dataElements')
+dataElements = d2getCached('dataElements.json?fields=id,name&paging=false', 'dataElements')
 
 #
 # Get the default categoryOptionCombo (which is also the default attributeOptionCombo)
 #
-defaultCoc = d2get('categoryOptionCombos.json?filter=name:eq:default', 'categoryOptionCombos')[0]['id']
+defaultCoc = sys.intern( d2getCached('categoryOptionCombos.json?filter=name:eq:default', 'categoryOptionCombos')[0]['id'] ) # Interned: stored twice in every output dataValue
 
 #
-# Make a dictionary from data element name to ID
+# Make a dictionary from data element name to ID, and a set of all the
+# data element IDs so output for data elements that don't exist in this
+# system can be dropped before it is sent.
 #
 elementNameId = {}
+validDataElementIds = set()
 for element in dataElements:
 	elementNameId[element['name']] = element['id']
+	validDataElementIds.add(element['id'])
 
 #
 # For all indicators that are grouped into areas, remember the area for each indicator
 #
-indicatorGroupSets = d2get('indicatorGroupSets.json?filter=name:eq:dash_indicators&fields=indicatorGroups[name,indicators[id]]&paging=false', 'indicatorGroupSets')
+indicatorGroupSets = d2getCached('indicatorGroupSets.json?filter=name:eq:dash_indicators&fields=indicatorGroups[name,indicators[id]]&paging=false', 'indicatorGroupSets')
 indicatorAreas = {}
 if indicatorGroupSets:
 	for indicatorGroup in indicatorGroupSets[0]['indicatorGroups']:
@@ -282,69 +353,138 @@ if indicatorGroupSets:
 			indicatorAreas[indicator['id']] = indicatorGroup['name']
 
 #
-# Assemble the input indicator data into nested dictionaries:
-# input [ peerGroup ] [ indicator ] [ orgUnit ] [ period ] { 'value', 'denominator' }
+# Assemble the input indicator data into nested dictionaries of arrays:
+# input [ peerGroup ] [ indicator ] [ orgUnit ] is a 2 x queryMonths
+# NumPy array, where row 0 holds the values and row 1 the denominators,
+# one column per month starting at firstQueryMonth. Months without data
+# are NaN. This packs each org unit's data contiguously instead of in
+# per-period dicts of Python floats.
 #
 indicatorErrorCount = 0
-input = {}
 queryMonths = monthCount+2
+firstQueryMonth = thisMonthNumber - queryMonths
+input = defaultdict( lambda: defaultdict( lambda: defaultdict(
+	lambda: numpy.full( (2, queryMonths), numpy.nan ) ) ) )
 allPeriods = [ toMonth(i) for i in range(thisMonthNumber-queryMonths, thisMonthNumber) ]
-for i in indicators:
-	if i['id'][0:4] == 'dash':
-		for level in dataOrgUnitLevels:
-			for loopCount in range( 0, math.ceil(float(queryMonths)/maxGetMonths) ):
-				lastQueryMonth = (loopCount+1)*maxGetMonths if (loopCount+1)*maxGetMonths < queryMonths else queryMonths
-				selectPeriods = ';'.join(allPeriods[loopCount*maxGetMonths:lastQueryMonth])
-				try:
-					rows = d2get('analytics.json?dimension=dx:' + i['id'] + '&dimension=ou:LEVEL-' + str(level) + '&dimension=pe:' + selectPeriods + '&skipMeta=true&includeNumDen=true', 'rows')
-				except Exception as e:
-					indicatorErrorCount = indicatorErrorCount + 1
-					break # After one error on this indicator, move on to the next indicator.
-				for r in rows:
-					indicator = r[0]
-					orgUnit = r[1]
-					period = toNumber( r[2] )
-					value = float( r[3] )
-					denominator = float( r[5] )
-					if orgUnit in peerGroupMap:
-						peerGroup = peerGroupMap[orgUnit]
-						if not peerGroup in input:
-							input[peerGroup] = {}
-						if not indicator in input[peerGroup]:
-							input[peerGroup][indicator] = {}
-						if not orgUnit in input[peerGroup][indicator]:
-							input[peerGroup][indicator][orgUnit] = {}
-						input[peerGroup][indicator][orgUnit][period] = { 'value': value, 'denominator': denominator }
+periodOffsets = { period: offset for offset, period in enumerate(allPeriods) } # Month string -> column in the input arrays
+dashIndicatorIds = [ i['id'] for i in indicators if i['id'][0:4] == 'dash' ]
+dataOrgUnits = sorted( peerGroupMap.keys() )
+maxGetIndicators = 25 # Keep the analytics URL well within server URL-length limits
+maxGetOrgUnits = 100 # Likewise for the ou dimension
+
+#
+# Build the list of analytics queries, then run them in parallel.
+# The queries name the peer group org units explicitly, so the server
+# only returns rows that will actually be used. The queries are
+# independent and spend nearly all their time waiting on the server,
+# so a thread pool overlaps the round trips.
+#
+analyticsQueries = []
+for batchStart in range( 0, len(dashIndicatorIds), maxGetIndicators ):
+	selectIndicators = ';'.join(dashIndicatorIds[batchStart:batchStart+maxGetIndicators])
+	for ouStart in range( 0, len(dataOrgUnits), maxGetOrgUnits ):
+		selectOrgUnits = ';'.join(dataOrgUnits[ouStart:ouStart+maxGetOrgUnits])
+		for loopCount in range( 0, math.ceil(float(queryMonths)/maxGetMonths) ):
+			lastQueryMonth = (loopCount+1)*maxGetMonths if (loopCount+1)*maxGetMonths < queryMonths else queryMonths
+			selectPeriods = ';'.join(allPeriods[loopCount*maxGetMonths:lastQueryMonth])
+			analyticsQueries.append('analytics.json?dimension=dx:' + selectIndicators + '&dimension=ou:' + selectOrgUnits + '&dimension=pe:' + selectPeriods + '&skipMeta=true&includeNumDen=true&ignoreLimit=true')
+
+def fetchRows(query):
+	try:
+		return d2get(query, 'rows')
+	except Exception as e:
+		return None # Count the error in the main thread
+
+#
+# Merge each batch of rows as soon as its query completes, on the main
+# thread only, so the workers keep fetching while we parse and no two
+# threads mutate the dicts. This also avoids holding every response in
+# memory at once.
+#
+with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+	futures = [ executor.submit(fetchRows, query) for query in analyticsQueries ]
+	for future in concurrent.futures.as_completed(futures):
+		rows = future.result()
+		if rows is None:
+			indicatorErrorCount = indicatorErrorCount + 1
+			continue
+		for r in rows:
+			orgUnit = r[1]
+			if orgUnit in peerGroupMap:
+				peerGroup = peerGroupMap[orgUnit]
+				# NumPy parses the value and denominator strings on assignment
+				input[peerGroup][r[0]][orgUnit][:, periodOffsets[r[2]]] = (r[3], r[5])
 
 # print('input', input) # debug
 
+#
+# Hash each peer group's input data (plus the months to compute). If the
+# cache directory holds the hashes from the last successful run, peer
+# groups whose hash is unchanged would produce exactly the same output
+# values as last time, so they can be skipped entirely.
+#
+stateFile = metadataCacheDir + '/state-' + hashlib.sha1( baseUrl.encode() ).hexdigest() + '.json' # Keyed by server, like the metadata cache files
+try:
+	previousInputHashes = json.loads(open(stateFile).read())
+except Exception:
+	previousInputHashes = {} # No saved state - compute everything
+
+# The seed covers everything besides the input data that the output
+# depends on: the months to compute, the peer group size cutoff, and
+# which data elements exist to receive values (possibly from a cached
+# metadata response - a refresh that adds data elements must recompute).
+hashSeed = ( str(monthCount) + ' ' + str(thisMonthNumber) + ' ' + str(minPeerGroupSize)
+	+ ' ' + ' '.join( sorted( validDataElementIds ) ) ).encode()
+inputHashes = {}
+for peerGroup, indicators in input.items():
+	groupHash = hashlib.sha1( hashSeed )
+	for indicator in sorted( indicators ):
+		groupHash.update( indicator.encode() )
+		orgUnits = indicators[indicator]
+		for orgUnit in sorted( orgUnits ):
+			groupHash.update( orgUnit.encode() )
+			groupHash.update( orgUnits[orgUnit].tobytes() )
+	inputHashes[peerGroup] = groupHash.hexdigest()
+
+unchangedPeerGroups = set( pg for pg, h in inputHashes.items() if previousInputHashes.get(pg) == h )
+# print('unchanged peer groups:', len(unchangedPeerGroups), 'of', len(inputHashes)) # debug
+
 #
 # Construct a list of data values to output.
 #
 def addAreaValue(areas, area, orgUnit, value):
-	if not area in areas:
-		areas[area] = {}
-	orgUnits = areas[area]
-	if not orgUnit in orgUnits:
-		orgUnits[orgUnit] = []
-	orgUnits[orgUnit].append( value )
+	areas.setdefault( area, {} ).setdefault( orgUnit, [] ).append( value )
 
 #
-# Initialze the output data and counts
+# Initialze the output data and counts. Pending values are buffered as
+# compact (orgUnit, period, dataElement, value) tuples; the JSON dicts
+# with the repeated option combo fields are built only at POST time.
 #
-output = { 'dataValues': [] }
+outputRows = []
 totalImported = 0
 totalUpdated = 0
 totalIgnored = 0
+postErrorCount = 0
 
 #
-# Periodically flush the output to avoid a POST that is too large
+# POST one batch of rows. This runs on the single post worker thread,
+# so the next batch can be computed while the server imports this one.
 #
-def flushOutput():
-	global output
+postCountsLock = threading.Lock()
+
+def postRows(rows):
 	global totalImported
 	global totalUpdated
 	global totalIgnored
+	global postErrorCount
+	output = { 'dataValues': [ {
+		'orgUnit': orgUnit,
+		'period': period,
+		'dataElement': dataElement,
+		'value': str( value ),
+		'categoryOptionCombo': defaultCoc,
+		'attributeOptionCombo': defaultCoc
+		} for orgUnit, period, dataElement, value in rows ] }
 	# print('POST: ',json.dumps(output)) # debug
 	for retry in range(20): # Sometimes gets an error, waiting and retrying helps
 		status = d2post( 'dataValueSets', output )
@@ -352,109 +492,129 @@ def flushOutput():
 		if success:
 			# print( 'POST success:', status.json() ) # debug
 			counts = status.json()['importCount']
-			totalImported = totalImported + counts['imported']
-			totalUpdated = totalUpdated + counts['updated']
-			totalIgnored = totalIgnored + counts['ignored']
+			with postCountsLock:
+				totalImported = totalImported + counts['imported']
+				totalUpdated = totalUpdated + counts['updated']
+				totalIgnored = totalIgnored + counts['ignored']
 			break
 		else:
 			time.sleep(10) # Wait before retrying
 	if not success:
+		with postCountsLock:
+			postErrorCount = postErrorCount + 1
 		print( 'Data post return status:', str(status), status.json() )
-	output = { 'dataValues': [] }
+
+#
+# Periodically flush the output to avoid a POST that is too large.
+# The POST happens on a background thread; at most two batches may be
+# in flight, so the computation cannot run far ahead of the server.
+#
+postExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+postFutures = deque()
+
+def flushOutput():
+	global outputRows
+	rows = outputRows
+	outputRows = []
+	while len(postFutures) >= 2:
+		postFutures.popleft().result() # Wait for the oldest batch to finish
+	postFutures.append( postExecutor.submit(postRows, rows) )
 
 #
 # Output data to DHIS 2.
 #
 def putOut(orgUnit, month, dataElement, value):
-	output['dataValues'].append( {
-		'orgUnit': orgUnit,
-		'period': month,
-		'dataElement': dataElement,
-		'value': str( value ),
-		'categoryOptionCombo': defaultCoc,
-		'attributeOptionCombo': defaultCoc
-		} )
-	if len(output['dataValues']) >= 4000:
+	if dataElement not in validDataElementIds:
+		return # The server would just ignore this value
+	outputRows.append( ( orgUnit, month, dataElement, value ) )
+	if len(outputRows) >= 4000:
 		flushOutput()
 
-def putOutByName(orgUnit, month, dataElementName, value):
-	if dataElementName in elementNameId:
-		putOut(orgUnit, month, elementNameId[dataElementName], value)
-	# else: # debug
-		# print("Warning: data element " + dataElementName + " not found.") # debug
-
-def threeMonths(periods, monthNumber, valueType):
-	data = []
-	for m in [monthNumber - 2, monthNumber - 1, monthNumber]:
-		if m in periods:
-			data.append(periods[m][valueType])
-	return data
+#
+# Mean of a small list. Much faster than statistics.mean, which does
+# exact-fraction arithmetic and type coercion on every call.
+#
+def listMean(values):
+	return sum(values) / len(values)
 
 for monthNumber in range(thisMonthNumber - monthCount, thisMonthNumber):
 	month = toMonth(monthNumber)
+	windowSlice = slice(monthNumber - 2 - firstQueryMonth, monthNumber + 1 - firstQueryMonth) # The 3 months ending at monthNumber
 	for peerGroup, indicators in input.items():
+		if peerGroup in unchangedPeerGroups:
+			continue # Input unchanged since the last run - output already imported
 		areas = {} # { area: { orgUnit: [ average1, average2, ... ] } }
 		for indicator, orgUnits in indicators.items():
-			averages = []
-			allPeersValues = []
+			ouMeans = {} # Compute each orgUnit's 3-month mean only once
+			ouDenominatorSums = {} # And its 3-month denominator sum in the same pass
+			allPeersSum = 0.0
+			allPeersCount = 0
 			for orgUnit, periods in orgUnits.items():
-				values = threeMonths(periods, monthNumber, 'value')
-				allPeersValues.extend(values)
+				window = periods[:, windowSlice] # Values in row 0, denominators in row 1
+				values = window[0]
+				values = values[ ~numpy.isnan(values) ]
 				# print('orgUnit:', orgUnit, 'periods:', periods, 'monthNumber:', monthNumber, 'values:', values)
 				if len(values) == 0:
 					continue # No indicator data for these 3 months for this orgUnit
-				average = int( round( statistics.mean( values ) ) )
-				averages.append( average )
+				denominators = window[1]
+				ouDenominatorSums[orgUnit] = int( denominators[ ~numpy.isnan(denominators) ].sum() )
+				allPeersSum += values.sum()
+				allPeersCount += len(values)
+				average = int( round( values.mean() ) )
+				ouMeans[orgUnit] = average
 				if indicator in indicatorAreas:
 					area = indicatorAreas[indicator]
 					addAreaValue( areas, area, orgUnit, average )
-			count = len( averages )
-			if count == 0:
-				continue # No indicator data for these 3 months for this orgUnit peer group
-			allPeersMean = int( round( statistics.mean( allPeersValues ) ) )
-			averages.sort()
-			q1 = int( round( averages [ int( (count-1) * .25 ) ] ) )
-			q2 = int( round( averages [ int( (count-1) * .5 ) ] ) )
-			q3 = int( round( averages [ int( (count-1) * .75 ) ] ) )
-			stddev = int( round( numpy.std( averages ) ) ) or 0 # If only 1 sample, return stddev = 0
-			# print( '\nmonth:', month, 'peerGroup:', peerGroup, 'indicator:', indicator, 'averages:', averages, 'q1-3:', q1, q2, q3, 'stddev:', stddev ) # debug
+			count = len( ouMeans )
+			if count == 0 or count < minPeerGroupSize:
+				continue # No indicator data for these 3 months, or too few peers for meaningful statistics
+			allPeersMean = int( round( allPeersSum / allPeersCount ) )
+			means = numpy.fromiter( ouMeans.values(), dtype=numpy.float64, count=count )
+			sortedAverages = numpy.sort( means )
+			quartileIndexes = ( (count-1) * numpy.array( [ .25, .5, .75 ] ) ).astype(int)
+			q1, q2, q3 = numpy.rint( sortedAverages [ quartileIndexes ] ).astype(int) # Rounds like Python round()
+			stddev = int( numpy.rint( sortedAverages.std() ) ) or 0 # If only 1 sample, return stddev = 0
+			bigRanks = numpy.searchsorted( sortedAverages, means, side='right' ) # big is best: counts averages <= each mean
+			smallRanks = count - bigRanks + 1 # small is best: counts averages > each mean, plus 1
+			percentiles = numpy.rint( 100.0 * bigRanks / count ).astype(int)
+			# print( '\nmonth:', month, 'peerGroup:', peerGroup, 'indicator:', indicator, 'q1-3:', q1, q2, q3, 'stddev:', stddev ) # debug
 			uidBase = 'de' + indicator[4:]
-			for orgUnit, periods in orgUnits.items():
-				values = threeMonths(periods, monthNumber, 'value')
-				if len(values) == 0:
-					continue # No indicator data for these 3 months for this orgUnit
-				mean = int( round( statistics.mean( values ) ) )
-				bigRank = sum( [ a <= mean for a in averages ] ) # big is best
-				percentile = int( round( 100 * float( bigRank ) / count ) )
-				smallRank = sum( [ a > mean for a in averages ] ) + 1 # small is best
-				denominatorSum = int( sum( threeMonths(periods, monthNumber, 'denominator') ) )
-				putOut( orgUnit, month, uidBase + 'Av', mean )
-				putOut( orgUnit, month, uidBase + 'Q1', q1 )
-				putOut( orgUnit, month, uidBase + 'Q2', q2 )
-				putOut( orgUnit, month, uidBase + 'Q3', q3 )
-				putOut( orgUnit, month, uidBase + 'DR', percentile )
-				putOut( orgUnit, month, uidBase + 'sz', count )
-				putOut( orgUnit, month, uidBase + 'or', bigRank )
-				putOut( orgUnit, month, uidBase + 'sr', smallRank )
-				putOut( orgUnit, month, uidBase + 'sd', stddev )
-				putOut( orgUnit, month, uidBase + 'DM', allPeersMean )
-				putOut( orgUnit, month, uidBase + 'd3', denominatorSum )
-				# print( 'Month:', month, 'peerGroup:', peerGroup, 'indicator:', indicator, 'orgUnit:', orgUnit, 'mean:', mean, 'smallRank:', smallRank, 'bigRank:', bigRank, 'percentile:', percentile, 'allPeersMean:', allPeersMean, 'denominatorSum:', denominatorSum, '3values:', threeMonths(periods, monthNumber, 'value'), '3denominators:', threeMonths(periods, monthNumber, 'denominator') ) # debug
+			deAv, deQ1, deQ2, deQ3, deDR, deSz, deOr, deSr, deSd, deDM, deD3 = \
+				( uidBase + s for s in ( 'Av', 'Q1', 'Q2', 'Q3', 'DR', 'sz', 'or', 'sr', 'sd', 'DM', 'd3' ) )
+			for ouIndex, (orgUnit, mean) in enumerate( ouMeans.items() ):
+				bigRank = bigRanks[ouIndex]
+				percentile = percentiles[ouIndex]
+				smallRank = smallRanks[ouIndex]
+				denominatorSum = ouDenominatorSums[orgUnit]
+				putOut( orgUnit, month, deAv, mean )
+				putOut( orgUnit, month, deQ1, q1 )
+				putOut( orgUnit, month, deQ2, q2 )
+				putOut( orgUnit, month, deQ3, q3 )
+				putOut( orgUnit, month, deDR, percentile )
+				putOut( orgUnit, month, deSz, count )
+				putOut( orgUnit, month, deOr, bigRank )
+				putOut( orgUnit, month, deSr, smallRank )
+				putOut( orgUnit, month, deSd, stddev )
+				putOut( orgUnit, month, deDM, allPeersMean )
+				putOut( orgUnit, month, deD3, denominatorSum )
+				# print( 'Month:', month, 'peerGroup:', peerGroup, 'indicator:', indicator, 'orgUnit:', orgUnit, 'mean:', mean, 'smallRank:', smallRank, 'bigRank:', bigRank, 'percentile:', percentile, 'allPeersMean:', allPeersMean, 'denominatorSum:', denominatorSum ) # debug
 
 		for area, orgUnitAverages in areas.items():
-			areaAverages = []
+			areaOuMeans = {} # Compute each orgUnit's area mean only once
 			for orgUnit, averages in orgUnitAverages.items():
-				average = int( round( statistics.mean( averages ) ) )
-				areaAverages.append ( average )
-			areaAverages.sort()
+				areaOuMeans[orgUnit] = int( round( listMean( averages ) ) )
+			areaAverages = sorted( areaOuMeans.values() )
 			count = len( areaAverages )
+			overallAverageId = elementNameId.get( 'Overall Average: ' + area )
+			overallRankId = elementNameId.get( 'Overall Rank: ' + area )
 			# print( '\nMonth:', month, 'area:', area, 'areaAverages:', areaAverages ) # debug
-			for orgUnit, averages in orgUnitAverages.items():
-				mean = int( round( statistics.mean( averages ) ) )
-				bigRank = sum( [ a <= mean for a in areaAverages ] )
+			for orgUnit, mean in areaOuMeans.items():
+				bigRank = bisect_right( areaAverages, mean ) # counts averages <= mean
 				percentile = int( round( 100 * float( bigRank ) / count ) )
-				putOutByName( orgUnit, month, 'Overall Average: ' + area, mean )
-				putOutByName( orgUnit, month, 'Overall Rank: ' + area, percentile )
+				if overallAverageId:
+					putOut( orgUnit, month, overallAverageId, mean )
+				if overallRankId:
+					putOut( orgUnit, month, overallRankId, percentile )
 
 				# print( 'OrgUnit:', orgUnit, 'month:', month, 'overall average:', mean, 'overall rank:', percentile ) # debug
 
@@ -462,6 +622,20 @@ for monthNumber in range(thisMonthNumber - monthCount, thisMonthNumber):
 # Finish importing the output data into the DHIS 2 system.
 #
 flushOutput()
+while postFutures:
+	postFutures.popleft().result()
+postExecutor.shutdown()
+
+#
+# Remember the input hashes for the next run, but only if this run
+# fetched and imported everything successfully - otherwise the next run
+# must compute everything again.
+#
+if indicatorErrorCount == 0 and postErrorCount == 0:
+	try:
+		open(stateFile, 'w').write(json.dumps(inputHashes))
+	except Exception:
+		pass # Cache directory may not exist or be writable
 
 #
 # Log the run in the monthly log file (if the log directory exists).